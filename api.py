@@ -1,12 +1,19 @@
-from fastapi import FastAPI, HTTPException, BackgroundTasks
+from fastapi import FastAPI, HTTPException, BackgroundTasks, Request
 import fastapi.responses
+import asyncio
 import datetime
+from collections import OrderedDict
+from typing import List
 from uuid import UUID
 import random
 
+from pydantic import BaseModel
+
 import app.holiday as holiday
 import app.db as db
+from app.responses import ImageFileResponse
 from tortoise.contrib.fastapi import register_tortoise
+from tortoise.transactions import in_transaction
 
 import os
 from dotenv import load_dotenv
@@ -22,6 +29,14 @@ load_dotenv()
 
 holiday_controller = holiday.HolidayController()
 
+# finished queries never change, so their ready state is kept in memory
+ready_queries = OrderedDict()
+READY_QUERIES_SIZE = 10000
+
+MAX_BATCH_SIZE = 100
+BATCH_CONCURRENCY = 4
+BATCH_LOOKUPS = 4
+
 description = """
 Holiday API allows you to get a list of holidays for a particular day
 and greeting cards images. 🎉
@@ -42,24 +57,63 @@ app = FastAPI(
     },)
 
 
+def _remember_ready(uuid):
+    ready_queries[uuid] = True
+    ready_queries.move_to_end(uuid)
+    if len(ready_queries) > READY_QUERIES_SIZE:
+        ready_queries.popitem(last=False)
+
+
 async def process_query(image_query: db.ImageQuery):
-    try:
-        logger.info(f'Background processing query "{image_query.query}" '
-                    f'[{image_query.uuid}]')
-
-        image = await holiday_controller.get_prepared_image_by_query(
-            image_query.query)
-        await holiday_controller._save_query_to_file(
-            f'{image_query.uuid}.png', image)
-
-        image_query.ready = True
-        await image_query.save()
-    except Exception:
-        if image_query.retries < 5:
+    while True:
+        try:
+            logger.info(f'Background processing query "{image_query.query}" '
+                        f'[{image_query.uuid}]')
+
+            # nobody is waiting here, so never fall back to another
+            # holiday's background, retry instead
+            image = await holiday_controller.get_prepared_image_by_query(
+                image_query.query, fallback=False)
+            await holiday_controller._save_query_to_file(
+                f'{image_query.uuid}.png', image)
+
+            image_query.ready = True
+            await image_query.save()
+            _remember_ready(image_query.uuid)
+            return
+        except Exception:
+            if image_query.retries >= 5:
+                return
+
             image_query.retries += 1
             await image_query.save()
 
-            return await process_query(image_query)
+            # back off so a struggling upstream is not hammered
+            await asyncio.sleep(2 ** image_query.retries)
+
+
+def _query_failed(image_query: db.ImageQuery):
+    # a query that succeeded on its last retry is not an error
+    return not image_query.ready and image_query.retries >= 5
+
+
+async def process_batch(uuids: List[UUID]):
+    image_queries = await db.ImageQuery.filter(uuid__in=uuids)
+
+    # queries for the same holiday share one image generation in the
+    # holiday controller, so they can run side by side
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def process(image_query):
+        async with semaphore:
+            await process_query(image_query)
+
+    await asyncio.gather(*(process(q) for q in image_queries))
+
+
+class BatchRequest(BaseModel):
+    queries: List[str] = []
+    dates: List[datetime.date] = []
 
 
 @app.get(
@@ -156,6 +210,10 @@ async def get_query_status(
         200: {
             "content": {"image/png": {}}
         },
+        206: {
+            "content": {"image/png": {}}
+        },
+        304: {},
         400: {
             "content": {"application/json": {}}
         },
@@ -166,22 +224,140 @@ async def get_query_status(
     response_class=fastapi.responses.Response
 )
 async def get_query_image(
-    id: UUID
+    id: UUID,
+    request: Request
 ):
-    print(str(id))
-    query = await db.ImageQuery.get_or_none(uuid=id)
+    if id in ready_queries:
+        ready_queries.move_to_end(id)
+    else:
+        query = await db.ImageQuery.get_or_none(uuid=id)
+
+        if not query:
+            raise HTTPException(
+                status_code=404,
+                detail="This query was not found")
+        if not query.ready:
+            raise HTTPException(
+                status_code=400,
+                detail="This query has not yet been processed")
+
+        _remember_ready(id)
 
-    if not query:
+    try:
+        return ImageFileResponse(
+            holiday_controller._get_query_path(f'{id}.png'),
+            request.headers)
+    except FileNotFoundError:
         raise HTTPException(
             status_code=404,
-            detail="This query was not found")
-    if not query.ready:
+            detail="This query image was not found")
+
+
+@app.post(
+    '/images/batch',
+    summary="Get holiday greeting images for several queries and dates",
+    response_description="Batch and image query identifiers",
+)
+async def create_batch(
+    batch: BatchRequest,
+    background_tasks: BackgroundTasks
+):
+    if not batch.queries and not batch.dates:
+        raise HTTPException(
+            status_code=400,
+            detail="Batch must contain queries or dates")
+    if len(batch.queries) + len(batch.dates) > MAX_BATCH_SIZE:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Batch can contain at most {MAX_BATCH_SIZE} items")
+    if any(date.year < 2010 for date in batch.dates):
         raise HTTPException(
             status_code=400,
-            detail="This query has not yet been processed")
+            detail="Dates before 2010 are not supported")
+
+    # a few lookups at a time, so a large batch does not trip the
+    # calend.ru circuit breaker by itself
+    semaphore = asyncio.Semaphore(BATCH_LOOKUPS)
+
+    async def get_date_holidays(date):
+        async with semaphore:
+            try:
+                holidays = await holiday_controller.get_date_holidays(date)
+            except Exception:
+                raise HTTPException(
+                    status_code=503,
+                    detail=f"Failed to get holidays for {date}")
+        if not holidays['holidays']:
+            raise HTTPException(
+                status_code=400,
+                detail=f"There are no holidays for {date}")
+        return holidays
+
+    unique_dates = list(set(batch.dates))
+    holidays = dict(zip(unique_dates, await asyncio.gather(
+        *(get_date_holidays(d) for d in unique_dates))))
+
+    items = [{'query': query} for query in batch.queries]
+    for date in batch.dates:
+        items.append({
+            'date': date,
+            'day': holidays[date]['day'],
+            'holiday': random.choice(holidays[date]['holidays'])
+        })
+
+    image_queries = [
+        db.ImageQuery(query=item.get('holiday', item.get('query')))
+        for item in items]
+    async with in_transaction() as connection:
+        await db.ImageQuery.bulk_create(image_queries, using_db=connection)
+        image_batch = await db.ImageBatch.create(
+            queries=[str(q.uuid) for q in image_queries],
+            using_db=connection)
+
+    background_tasks.add_task(
+        process_batch, [q.uuid for q in image_queries])
+
+    for item, image_query in zip(items, image_queries):
+        item['query'] = image_query.uuid
+
+    return {
+        'batch': image_batch.uuid,
+        'queries': items
+    }
+
+
+@app.get(
+    '/batches/{id}',
+    summary="Get batch status"
+)
+async def get_batch_status(
+    id: UUID
+):
+    batch = await db.ImageBatch.get_or_none(uuid=id)
+
+    if not batch:
+        raise HTTPException(
+            status_code=404,
+            detail="This batch was not found")
+
+    queries = await db.ImageQuery.filter(uuid__in=batch.queries)
+    ready = sum(query.ready for query in queries)
+    failed = sum(_query_failed(query) for query in queries)
+
+    return {
+        'id': batch.uuid,
+        'total': len(queries),
+        'ready': ready,
+        'error': failed,
+        'pending': len(queries) - ready - failed,
+        'queries': [{
+            'id': query.uuid,
+            'query': query.query,
+            'ready': query.ready,
+            'error': _query_failed(query)
+        } for query in queries]
+    }
 
-    img = await holiday_controller._read_query_from_file(f'{query.uuid}.png')
-    return fastapi.responses.Response(content=img, media_type="image/png")
 
 register_tortoise(
     app,
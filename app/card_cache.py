@@ -0,0 +1,118 @@
+import asyncio
+import hashlib
+import os
+import uuid
+from collections import OrderedDict, namedtuple
+from pathlib import Path
+
+import aiofiles
+
+CardVariant = namedtuple('CardVariant', ['holiday', 'background', 'overlay',
+                                         'seed', 'format'])
+
+
+class CardCache:
+    """Two-tier cache of rendered greeting cards.
+
+    Recently used cards are kept in memory up to max_bytes, everything
+    else is read back from disk. The disk tier is limited to
+    max_disk_bytes; the least recently used files (by mtime) are removed
+    when it grows over the limit.
+    """
+
+    def __init__(self, path='./cache/cards', max_bytes=64 * 1024 * 1024,
+                 max_disk_bytes=512 * 1024 * 1024):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.max_disk_bytes = max_disk_bytes
+
+        self.items = OrderedDict()
+        self.size = 0
+        self.disk_size = sum(entry.stat().st_size
+                             for entry in os.scandir(self.path))
+        self.pruning = None
+
+    def _filepath(self, variant: CardVariant):
+        digest = hashlib.sha1(repr(tuple(variant)).encode()).hexdigest()
+        return self.path / f'{digest}.{variant.format}'
+
+    def _remember(self, variant, data):
+        if len(data) > self.max_bytes:
+            return
+
+        if variant in self.items:
+            self.size -= len(self.items.pop(variant))
+        self.items[variant] = data
+        self.size += len(data)
+
+        while self.size > self.max_bytes:
+            _, evicted = self.items.popitem(last=False)
+            self.size -= len(evicted)
+
+    async def get(self, variant: CardVariant):
+        if variant in self.items:
+            self.items.move_to_end(variant)
+            return self.items[variant]
+
+        loop = asyncio.get_event_loop()
+        data = await loop.run_in_executor(
+            None, self._read, self._filepath(variant))
+        if data is not None:
+            self._remember(variant, data)
+        return data
+
+    def _read(self, filepath):
+        try:
+            with open(filepath, 'rb') as f:
+                data = f.read()
+            # mark the file as recently used for pruning
+            os.utime(filepath)
+        except FileNotFoundError:
+            return None
+        return data
+
+    async def put(self, variant: CardVariant, data):
+        self._remember(variant, data)
+
+        filepath = self._filepath(variant)
+        temp_path = filepath.with_name(f'{uuid.uuid4()}.tmp')
+        async with aiofiles.open(temp_path, 'wb') as f:
+            await f.write(data)
+        os.replace(temp_path, filepath)
+
+        self.disk_size += len(data)
+        if self.disk_size > self.max_disk_bytes and self.pruning is None:
+            # the card is returned right away, pruning runs on its own
+            loop = asyncio.get_event_loop()
+            self.pruning = loop.run_in_executor(None, self._prune)
+            self.pruning.add_done_callback(self._pruned)
+
+    def _pruned(self, future):
+        self.pruning = None
+        if not future.cancelled() and future.exception() is None:
+            self.disk_size = future.result()
+
+    def _prune(self):
+        entries = []
+        for entry in os.scandir(self.path):
+            try:
+                stat_result = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append(
+                (stat_result.st_mtime, stat_result.st_size, entry.path))
+        entries.sort()
+        disk_size = sum(size for _, size, _ in entries)
+
+        # free some room at once instead of pruning on every put
+        target = self.max_disk_bytes * 0.9
+        for _, size, path in entries:
+            if disk_size <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            disk_size -= size
+        return disk_size
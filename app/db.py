@@ -42,3 +42,40 @@ class ImageQuery(Model):
 
     class Meta:
         table = "image_queries"
+
+
+class RandomHoliday(Model):
+    id = fields.IntField(pk=True)
+    date = fields.DateField()
+    day = fields.TextField()
+    name = fields.TextField()
+    created_at = fields.DatetimeField(auto_now_add=True)
+
+    class Meta:
+        table = "random_holidays"
+        unique_together = (("date", "name"),)
+
+
+class PlannedHoliday(Model):
+    id = fields.IntField(pk=True)
+    date = fields.DateField()
+    day = fields.TextField()
+    name = fields.TextField()
+    demand = fields.IntField(default=0)
+    done = fields.BooleanField(default=False)
+    attempts = fields.SmallIntField(default=0)
+    generated_at = fields.DatetimeField(null=True)
+    created_at = fields.DatetimeField(auto_now_add=True)
+
+    class Meta:
+        table = "planned_holidays"
+
+
+class ImageBatch(Model):
+    id = fields.IntField(pk=True)
+    uuid = fields.UUIDField(default=uuid.uuid4)
+    queries = fields.JSONField()
+    created_at = fields.DatetimeField(auto_now_add=True)
+
+    class Meta:
+        table = "image_batches"
@@ -4,25 +4,31 @@ import lxml.html
 import datetime
 import random
 import io
+import time
 import aiofiles
 
-from PIL import Image, ImageFont, ImageDraw
+from PIL import Image, ImageDraw
 
 import pymorphy2
 from pyphrasy.inflect import PhraseInflector
 
 from google_images_download import google_images_download
 
-from app.db import HolidayCache
+from app.card_cache import CardCache, CardVariant
+from app.db import HolidayCache, PlannedHoliday
 
+from collections import OrderedDict
 from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 from pathlib import Path
 
 import tortoise
 
+import app.layout
 import app.log
 
+from app.random_index import RandomHolidayIndex
+from app.resilience import CircuitBreaker, CircuitOpenError
 from app.scrapers.wombo import WomboScraper
 
 import os
@@ -37,6 +43,37 @@ class HolidayController:
         self.banned_parts = os.getenv('BANNED_PARTS').split(',')
 
         self.downloader = google_images_download.googleimagesdownload()
+        self.random_index = RandomHolidayIndex()
+
+        self.thread_pool = ThreadPoolExecutor()
+        self.card_cache = CardCache(
+            max_bytes=int(os.getenv('CARD_CACHE_MB', 64)) * 1024 * 1024,
+            max_disk_bytes=int(
+                os.getenv('CARD_CACHE_DISK_MB', 512)) * 1024 * 1024)
+        self.card_variants = int(os.getenv('CARD_VARIANTS', 16))
+        self.overlays = sorted(p.name for p in Path('./img').glob('*'))
+        self.backgrounds = {}
+
+        self.queries_path = Path("./cache/queries")
+        self.queries_path.mkdir(parents=True, exist_ok=True)
+
+        self.calend_breaker = CircuitBreaker('calend.ru')
+        self.wombo_breaker = CircuitBreaker(
+            'wombo', failure_threshold=3, reset_timeout=300)
+        self.calend_timeout = int(os.getenv('CALEND_TIMEOUT', 10))
+        self.wombo_timeout = int(os.getenv('WOMBO_TIMEOUT', 90))
+        self.wombo_request_timeout = int(
+            os.getenv('WOMBO_REQUEST_TIMEOUT', 60))
+
+        # last known good holidays by date, served while being refreshed
+        self.holidays_cache = OrderedDict()
+        self.holidays_cache_size = 1000
+        self.holidays_ttl = 6 * 60 * 60
+        self.refreshing = set()
+        self.background_tasks = set()
+
+        # running image generation per holiday name
+        self.generating = {}
 
     async def _filter_holidays(self, holidays):
         result = []
@@ -57,36 +94,159 @@ class HolidayController:
         holiday_cache.accessed_at = tortoise.timezone.now()
         await holiday_cache.save()
 
-        if holiday_cache.images_count <= 0:
-            images_count = await self.download_images(holiday_cache, 5)
-            holiday_cache.images_count = images_count
-            await holiday_cache.save()
+        render_cache = await self._ensure_images(holiday_cache)
+
+        if holiday_cache.images_count > 0:
+            await self.random_index.add(date, holidays['day'], holiday)
+
+        return (await self._get_prepared_image(render_cache)), holidays['day']
 
-        return (await self._get_prepared_image(holiday_cache)), holidays['day']
+    async def get_random_prepared_image(self):
+        while len(self.random_index):
+            date, day, holiday = self.random_index.sample()
+            holiday_cache = await HolidayCache.filter(
+                name=holiday, images_count__gt=0).first()
+            if holiday_cache:
+                return (await self._get_prepared_image(holiday_cache)), day
 
-    async def get_prepared_image_by_query(self, query):
+            # the holiday lost its images, drop it and try another one
+            self.random_index.remove(date, holiday)
+
+        # index is empty (fresh install), fall back to scraping
+        return await self.get_date_prepared_image(self._get_random_date())
+
+    async def get_prepared_image_by_query(self, query, fallback=True):
         holiday_cache, _ = await HolidayCache.get_or_create(name=query)
         holiday_cache.accessed_at = tortoise.timezone.now()
         await holiday_cache.save()
 
-        if holiday_cache.images_count <= 0:
-            images_count = await self.download_images(holiday_cache, 5)
+        return await self._get_prepared_image(
+            await self._ensure_images(holiday_cache, fallback))
+
+    async def _ensure_images(self, holiday_cache, fallback=True):
+        if holiday_cache.images_count > 0:
+            return holiday_cache
+
+        if not fallback:
+            await self.generate_images(holiday_cache, 5)
+            return holiday_cache
+
+        try:
+            # a single image is enough to render the card
+            await asyncio.wait_for(
+                self.generate_images(holiday_cache, 1),
+                self.wombo_request_timeout)
+        except (CircuitOpenError, asyncio.TimeoutError, aiohttp.ClientError):
+            fallbacks = await HolidayCache.filter(
+                images_count__gt=0).order_by('-accessed_at').limit(20)
+            if not fallbacks:
+                raise
+
+            # Wombo is slow or down, render the requested caption over
+            # another holiday's background, generation goes on
+            self.logger.warning(f'Wombo is unavailable, using a cached '
+                                f'background for {holiday_cache.name}')
+            background_cache = random.choice(fallbacks)
+            return HolidayCache(name=holiday_cache.name,
+                                directory=background_cache.directory,
+                                images_count=background_cache.images_count)
+
+        if holiday_cache.images_count < 5:
+            # top up the fast path in the background
+            self._start_generation(
+                holiday_cache, 5 - holiday_cache.images_count)
+        return holiday_cache
+
+    async def generate_images(self, holiday_cache, count=10, timeout=None):
+        # shielded, so a caller giving up does not cancel the generation
+        holiday_cache.images_count = await asyncio.shield(
+            self._start_generation(holiday_cache, count, timeout))
+        return holiday_cache.images_count
+
+    def _start_generation(self, holiday_cache, count, timeout=None):
+        # one generation per holiday at a time, requests, background
+        # top-ups and the planner all wait for the same one
+        task = self.generating.get(holiday_cache.name)
+        if task is not None:
+            return task
+
+        async def generate():
+            images_count = await self.download_images(
+                holiday_cache, count, timeout=timeout)
             holiday_cache.images_count = images_count
             await holiday_cache.save()
+            return images_count
+
+        task = asyncio.ensure_future(generate())
+        self.generating[holiday_cache.name] = task
+        task.add_done_callback(
+            partial(self._generation_done, holiday_cache.name))
+        return task
+
+    def _generation_done(self, name, task):
+        if self.generating.get(name) is task:
+            del self.generating[name]
+        if not task.cancelled() and task.exception():
+            self.logger.opt(exception=task.exception()).error(
+                f'Failed to download images for {name}')
+
+    def _run_in_background(self, key, coro):
+        if key in self.refreshing:
+            coro.close()
+            return
+
+        async def run():
+            try:
+                await coro
+            except Exception:
+                self.logger.exception(f'Background refresh {key} failed')
+            finally:
+                self.refreshing.discard(key)
+
+        self.refreshing.add(key)
+        task = asyncio.ensure_future(run())
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+
+    def _get_backgrounds(self, holiday_cache):
+        # keyed by images count, so a top-up shows up in every process
+        key = (holiday_cache.directory, holiday_cache.images_count)
+        if key not in self.backgrounds:
+            path = Path(f"./cache/{holiday_cache.directory}")
+            backgrounds = sorted(p.name for p in path.glob('*')
+                                 if p.suffix != '.tmp')
+            if not backgrounds:
+                return backgrounds
+            self.backgrounds[key] = backgrounds
+        return self.backgrounds[key]
+
+    def _pick_variant(self, holiday_cache, format='png'):
+        # every holiday has a fixed set of variants, so a random looking
+        # card can still be served from the card cache
+        variant = random.randrange(self.card_variants)
+        rng = random.Random(f'{holiday_cache.name}:{variant}')
+
+        background = rng.choice(self._get_backgrounds(holiday_cache))
+        return CardVariant(
+            holiday=holiday_cache.name,
+            background=f'{holiday_cache.directory}/{background}',
+            overlay=rng.choice(self.overlays),
+            seed=rng.getrandbits(32),
+            format=format)
+
+    async def _get_prepared_image(self, holiday_cache, format='png'):
+        variant = self._pick_variant(holiday_cache, format)
+
+        resulting_image = await self.card_cache.get(variant)
+        if resulting_image is not None:
+            return resulting_image
 
-        return await self._get_prepared_image(holiday_cache)
-
-    async def _get_prepared_image(self, holiday_cache):
         loop = asyncio.get_event_loop()
-        thread_pool = ThreadPoolExecutor()
         resulting_image = await loop.run_in_executor(
-            thread_pool,
-            partial(
-                self._prepare_image_sync,
-                holiday_cache.name,
-                holiday_cache.directory
-            )
+            self.thread_pool,
+            partial(self._prepare_image_sync, variant)
         )
+        await self.card_cache.put(variant, resulting_image)
         return resulting_image
 
     def _get_greeting(self, holiday):
@@ -95,94 +255,101 @@ class HolidayController:
         return 'С ' + inflector.inflect(holiday, 'ablt')
 
     def _get_random_date(self):
-        year = datetime.datetime.now().year
-        # try to get a date
-        try:
-            return datetime.datetime.strptime(
-                '{} {}'.format(random.randint(1, 366), year), '%j %Y').date()
-        # if the value happens to be in the leap year range, try again
-        except ValueError:
-            return self.get_random_date()
-
-    def _text_wrap(self, text, font, max_width):
-        lines = []
-        # If the width of the text is smaller than image width
-        # we don't need to split it, just add it to the lines array
-        # and return
-        if font.getsize(text)[0] <= max_width:
-            lines.append(text)
-        else:
-            # split the line by spaces to get words
-            words = text.split(' ')
-            i = 0
-            # append every word to a line
-            # while its width is shorter than image width
-            while i < len(words):
-                line = ''
-                while (
-                        i < len(words) and
-                        font.getsize(line + words[i])[0] <= max_width):
-                    line = line + words[i] + " "
-                    i += 1
-                if not line:
-                    line = words[i]
-                    i += 1
-                # when the line gets longer than the
-                # max width do not append the word,
-                # add the line to the lines array
-                lines.append(line)
-        return lines
-
-    def _draw_greeting_card(self, content, text):
-        background = Image.open(io.BytesIO(content))
-        overplay_dir = Path('./img')
-        overlay_path = random.choice(list(overplay_dir.glob('*')))
+        first_day = datetime.date(datetime.date.today().year, 1, 1)
+        days = (first_day.replace(year=first_day.year + 1) - first_day).days
+        return first_day + datetime.timedelta(days=random.randrange(days))
 
-        overlay = Image.open(overlay_path.resolve())
+    def _draw_greeting_card(self, content, text, overlay_name, seed,
+                            format='png'):
+        rng = random.Random(seed)
+
+        background = Image.open(io.BytesIO(content))
+        overlay = Image.open(Path('./img', overlay_name).resolve())
         ow, oh = overlay.size
 
-        ow = random.randint(10, ow)
-        oh = random.randint(10, oh)
+        ow = rng.randint(10, ow)
+        oh = rng.randint(10, oh)
         overlay = overlay.resize((ow, oh))
 
         bw, bh = background.size
 
-        x = random.randint(0, abs(bw-ow))
-        y = random.randint(0, abs(bh-oh))
+        x = rng.randint(0, abs(bw-ow))
+        y = rng.randint(0, abs(bh-oh))
 
         background.paste(overlay, (x, y), overlay)
 
-        font = ImageFont.truetype("lobster.ttf", int(bw/16))
+        layout = app.layout.fit_text(
+            text, bw, int(bh/3), int(bw/16))
+        font = app.layout.get_font(layout.size)
         draw = ImageDraw.Draw(background)
-        lines = self._text_wrap(text, font, bw)
-        line_height = font.getsize('hg')[1]
 
         # te_x = 10
-        te_y = bh - (len(lines)*line_height)
+        te_y = bh - (len(layout.lines)*layout.line_height)
 
-        for line in lines:
-            tfw, tfh = draw.textsize(line, font=font)
+        for line, tfw in zip(layout.lines, layout.widths):
             draw.text((int((bw-tfw)/2)-1, te_y-1), line, (0, 0, 0), font=font)
             draw.text(
                 (int((bw-tfw)/2), te_y),
                 line, (255, 255, 255), font=font)
-            te_y += line_height
+            te_y += layout.line_height
+
+        if format == 'jpeg':
+            background = background.convert('RGB')
 
         temp = io.BytesIO()
-        background.save(temp, format="png")
+        background.save(temp, format=format)
         return temp.getvalue()
 
-    def _prepare_image_sync(self, holiday, directory):
-        path = Path(f"./cache/{directory}")
-        image_path = random.choice(list(path.glob('*')))
+    def _prepare_image_sync(self, variant: CardVariant):
+        image_path = Path('./cache', variant.background)
 
-        greeting = self._get_greeting(holiday)
+        greeting = self._get_greeting(variant.holiday)
 
         with open(image_path.resolve(), 'rb') as f:
             content = f.read()
-            return self._draw_greeting_card(content, greeting)
+            return self._draw_greeting_card(
+                content, greeting, variant.overlay, variant.seed,
+                variant.format)
 
     async def get_date_holidays(self, date: datetime.date):
+        cached = self.holidays_cache.get(date)
+        if cached:
+            fetched_at, holidays = cached
+            if time.monotonic() - fetched_at > self.holidays_ttl:
+                self._run_in_background(
+                    ('holidays', date), self._refresh_holidays(date))
+            return holidays
+
+        try:
+            return await self._refresh_holidays(date)
+        except Exception:
+            holidays = await self._get_planned_holidays(date)
+            if not holidays:
+                raise
+            self.logger.warning(f'calend.ru is unavailable, using planned '
+                                f'holidays for {date}')
+            return holidays
+
+    async def _refresh_holidays(self, date):
+        holidays = await self.calend_breaker.call(
+            self._fetch_date_holidays, date, timeout=self.calend_timeout)
+
+        self.holidays_cache[date] = (time.monotonic(), holidays)
+        self.holidays_cache.move_to_end(date)
+        if len(self.holidays_cache) > self.holidays_cache_size:
+            self.holidays_cache.popitem(last=False)
+        return holidays
+
+    async def _get_planned_holidays(self, date):
+        planned = await PlannedHoliday.filter(date=date)
+        if not planned:
+            return None
+        return {
+            'day': planned[0].day,
+            'holidays': [p.name for p in planned]
+        }
+
+    async def _fetch_date_holidays(self, date: datetime.date):
         async with aiohttp.ClientSession() as session:
             url = 'https://www.calend.ru/day/'
             url += f'{date.year}-{date.month}-{date.day}'
@@ -210,27 +377,50 @@ class HolidayController:
             f'Updated today holidays ({self.today["day"]}): '
             f'{str(self.today["holidays"])}')
 
+        # images are generated by the planner, which covers today too
         for holiday in self.today['holidays']:
             holiday_cache, _ = await HolidayCache.get_or_create(name=holiday)
             holiday_cache.accessed_at = tortoise.timezone.now()
             await holiday_cache.save()
 
-            if holiday_cache.images_count <= 0:
-                try:
-                    images_count = await self.download_images(holiday_cache)
-                    holiday_cache.images_count = images_count
-                    await holiday_cache.save()
-                except Exception:
-                    self.logger.exception(f'Failed to download images '
-                                          f'for {holiday_cache.name}')
+            if holiday_cache.images_count > 0:
+                await self.random_index.add(
+                    datetime.date.today(), self.today['day'], holiday)
+
+    async def grow_random_index(self, attempts=10):
+        # pick an upcoming day that is neither indexed nor planned yet
+        today = datetime.date.today()
+        for _ in range(attempts):
+            date = today + datetime.timedelta(days=random.randint(1, 365))
+            if not self.random_index.has_date(date) and \
+                    not await PlannedHoliday.filter(date=date).exists():
+                break
+        else:
+            return
+
+        holidays = await self.get_date_holidays(date)
+
+        # the planner generates images for these within its nightly
+        # budget and adds them to the index, after holidays for the
+        # next few days
+        for holiday in holidays['holidays']:
+            await PlannedHoliday.get_or_create(
+                date=date, name=holiday,
+                defaults={'day': holidays['day'], 'demand': 0})
 
-    async def download_images(self, holiday_cache: HolidayCache, count=10):
+        self.logger.info(f'Planned {len(holidays["holidays"])} holidays '
+                         f'of {holidays["day"]} for the random index')
+
+    async def download_images(self, holiday_cache: HolidayCache, count=10,
+                              timeout=None):
         # loop = asyncio.get_event_loop()
         # thread_pool = ThreadPoolExecutor()
 
         self.logger.info(f'Downloading images for: {holiday_cache.name}')
 
-        return await WomboScraper().download_images(holiday_cache, count)
+        return await self.wombo_breaker.call(
+            WomboScraper().download_images, holiday_cache, count,
+            timeout=timeout or self.wombo_timeout * count)
 
         # downloaded_count = await loop.run_in_executor(
         #     thread_pool,
@@ -263,18 +453,10 @@ class HolidayController:
     #                               f'for {holiday_title}')
     #         return 0
 
-    async def _save_query_to_file(self, filename, data):
-        path = Path("./cache/queries")
-        path.mkdir(parents=True, exist_ok=True)
+    def _get_query_path(self, filename):
+        return self.queries_path / filename
 
-        filepath = path / filename
+    async def _save_query_to_file(self, filename, data):
+        filepath = self._get_query_path(filename)
         async with aiofiles.open(filepath, 'wb') as f:
             await f.write(data)
-
-    async def _read_query_from_file(self, filename):
-        path = Path("./cache/queries")
-        path.mkdir(parents=True, exist_ok=True)
-
-        filepath = path / filename
-        async with aiofiles.open(filepath, 'rb') as f:
-            return await f.read()
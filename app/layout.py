@@ -0,0 +1,83 @@
+from collections import namedtuple
+from functools import lru_cache
+
+from PIL import ImageFont
+
+FONT_PATH = 'lobster.ttf'
+MIN_FONT_SIZE = 12
+
+TextLayout = namedtuple('TextLayout', ['size', 'lines', 'widths',
+                                       'line_height'])
+
+
+@lru_cache(maxsize=64)
+def get_font(size):
+    return ImageFont.truetype(FONT_PATH, size)
+
+
+@lru_cache(maxsize=4096)
+def _word_width(word, size):
+    return get_font(size).getlength(word)
+
+
+@lru_cache(maxsize=64)
+def _line_height(size):
+    ascent, descent = get_font(size).getmetrics()
+    return ascent + descent
+
+
+def _wrap(words, size, max_width):
+    # every word is measured once, line widths are summed from
+    # word widths instead of re-measuring the growing line
+    space = _word_width(' ', size)
+    lines = []
+    widths = []
+    line = []
+    width = 0
+    for word in words:
+        word_width = _word_width(word, size)
+        if line and width + space + word_width > max_width:
+            lines.append(' '.join(line))
+            widths.append(width)
+            line = [word]
+            width = word_width
+        else:
+            width = width + space + word_width if line else word_width
+            line.append(word)
+    if line:
+        lines.append(' '.join(line))
+        widths.append(width)
+    return lines, widths
+
+
+def _layout(words, size, max_width):
+    lines, widths = _wrap(words, size, max_width)
+    return TextLayout(size, tuple(lines), tuple(int(w) for w in widths),
+                      _line_height(size))
+
+
+def _fits(layout, max_width, max_height):
+    return (len(layout.lines) * layout.line_height <= max_height and
+            max(layout.widths, default=0) <= max_width)
+
+
+@lru_cache(maxsize=1024)
+def fit_text(text, max_width, max_height, max_size):
+    """Wrap text with the largest font size that fits into the box.
+
+    Layouts are cached by (text, width, height budget, max font size),
+    so captions that repeat cost nothing after the first render.
+    """
+    words = tuple(text.split())
+    low, high = MIN_FONT_SIZE, max(max_size, MIN_FONT_SIZE)
+
+    best = _layout(words, low, max_width)
+    while low <= high:
+        size = (low + high) // 2
+        layout = _layout(words, size, max_width)
+        if _fits(layout, max_width, max_height):
+            best = layout
+            low = size + 1
+        else:
+            high = size - 1
+    return best
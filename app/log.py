@@ -1,9 +1,13 @@
+import atexit
 import os
+import queue
+import threading
+import time
+from collections import Counter
 
 from loguru import logger
 
 import notifiers
-from notifiers.logging import NotificationHandler
 
 from dotenv import load_dotenv
 
@@ -14,16 +18,101 @@ params = {
     'token': os.getenv('TG_TOKEN')
 }
 
-notifier = notifiers.get_notifier('telegram')
-notifier.notify(message='The application is running!', **params)
 
-handler = NotificationHandler('telegram', defaults=params)
+class TelegramSink:
+    """Loguru sink that sends log messages to Telegram in the background.
+
+    Logging only puts the message into a bounded queue; a worker thread
+    collects batches, collapses duplicates and sends them no more often
+    than min_interval. Messages are dropped when the queue is full.
+    """
+
+    max_length = 4000
+
+    def __init__(self, params, max_queue=1000, batch_interval=5,
+                 min_interval=3):
+        self.params = params
+        self.notifier = notifiers.get_notifier('telegram')
+
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.batch_interval = batch_interval
+        self.min_interval = min_interval
+        self.dropped = 0
+
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+
+        atexit.register(self.stop)
+
+    def write(self, message):
+        try:
+            self.queue.put_nowait(str(message).strip())
+        except queue.Full:
+            self.dropped += 1
+
+    def stop(self, timeout=5):
+        self.stopped.set()
+        self.thread.join(timeout)
+
+    def _collect(self):
+        messages = []
+        deadline = None
+        while not (self.stopped.is_set() and self.queue.empty()):
+            timeout = 1 if deadline is None \
+                else deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                messages.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                continue
+            if deadline is None:
+                deadline = time.monotonic() + self.batch_interval
+        return messages
+
+    def _format(self, messages):
+        lines = []
+        for message, count in Counter(messages).items():
+            lines.append(message if count == 1
+                         else f'{message}\n(repeated {count} times)')
+
+        if self.dropped:
+            lines.append(f'({self.dropped} messages dropped)')
+            self.dropped = 0
+
+        chunks = ['']
+        for line in lines:
+            line = line[:self.max_length]
+            if len(chunks[-1]) + len(line) + 2 > self.max_length:
+                chunks.append('')
+            chunks[-1] += line + '\n\n'
+        return [chunk for chunk in chunks if chunk]
+
+    def _worker(self):
+        while not (self.stopped.is_set() and self.queue.empty()):
+            messages = self._collect()
+            if not messages:
+                continue
+
+            for chunk in self._format(messages):
+                try:
+                    self.notifier.notify(message=chunk, **self.params)
+                except Exception:
+                    pass
+                if not self.stopped.is_set():
+                    time.sleep(self.min_interval)
+
+
+sink = TelegramSink(params)
+sink.write('The application is running!')
 
 if not os.path.exists('logs'):
     os.makedirs('logs')
 
 logger.add("logs/app.log", rotation="1 day", level=os.getenv('LOGGING_LEVEL'))
-logger.add(handler, level=os.getenv('LOGGING_NOTIFY_LEVEL'))
+logger.add(sink, level=os.getenv('LOGGING_NOTIFY_LEVEL'),
+           format="{level}: {message}")
 
 
 def get_logger(logger_name):
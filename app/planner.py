@@ -0,0 +1,152 @@
+import asyncio
+import datetime
+
+import tortoise
+from tortoise.functions import Count
+
+import app.log
+from app.db import HolidayCache, ImageQuery, PlannedHoliday
+
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+class GenerationPlanner:
+    """Generates images for the upcoming days' holidays at night.
+
+    The plan is kept in the planned_holidays table, so every run picks up
+    whatever is still pending. Each night is limited to PLANNER_BUDGET
+    generations, PLANNER_CONCURRENCY at a time, and only runs between
+    PLANNER_WINDOW_START and PLANNER_WINDOW_END (hours). The window may
+    cross midnight, e.g. 22 to 4.
+    """
+
+    max_attempts = 3
+
+    def __init__(self, holiday_controller):
+        self.holiday_controller = holiday_controller
+        self.logger = app.log.get_logger('planner')
+
+        self.days = int(os.getenv('PLANNER_DAYS', 3))
+        self.budget = int(os.getenv('PLANNER_BUDGET', 20))
+        self.concurrency = int(os.getenv('PLANNER_CONCURRENCY', 2))
+        self.window_start = int(os.getenv('PLANNER_WINDOW_START', 0))
+        self.window_end = int(os.getenv('PLANNER_WINDOW_END', 6))
+
+        if not (0 <= self.window_start < 24 and 0 <= self.window_end < 24
+                and self.window_start != self.window_end):
+            raise ValueError('Invalid planner window '
+                             f'{self.window_start}-{self.window_end}')
+
+    def _in_window(self, now=None):
+        hour = (now or datetime.datetime.now()).hour
+        if self.window_start < self.window_end:
+            return self.window_start <= hour < self.window_end
+        return hour >= self.window_start or hour < self.window_end
+
+    @property
+    def window_hours(self):
+        # cron expression for every hour of the window
+        hours = [hour for hour in range(24)
+                 if self._in_window(datetime.datetime(2000, 1, 1, hour))]
+        return ','.join(map(str, hours))
+
+    async def plan(self):
+        today = datetime.date.today()
+        days = {}
+        for offset in range(self.days + 1):
+            date = today + datetime.timedelta(days=offset)
+            try:
+                days[date] = await self.holiday_controller.get_date_holidays(
+                    date)
+            except Exception:
+                self.logger.exception(f'Failed to plan holidays for {date}')
+
+        names = {name for holidays in days.values()
+                 for name in holidays['holidays']}
+        if not names:
+            return
+
+        # holidays people asked for through the API go first
+        demands = dict(await ImageQuery.filter(query__in=names)
+                       .annotate(demand=Count('id')).group_by('query')
+                       .values_list('query', 'demand'))
+
+        for date, holidays in days.items():
+            for holiday in holidays['holidays']:
+                demand = demands.get(holiday, 0)
+                planned, created = await PlannedHoliday.get_or_create(
+                    date=date, name=holiday,
+                    defaults={'day': holidays['day'], 'demand': demand})
+                if not created and planned.demand != demand:
+                    planned.demand = demand
+                    await planned.save()
+
+    async def run(self):
+        if not self._in_window():
+            return
+
+        await self.plan()
+
+        now = datetime.datetime.now()
+        since_start = now - now.replace(
+            hour=self.window_start, minute=0, second=0, microsecond=0)
+        if since_start < datetime.timedelta(0):
+            # the window started yesterday
+            since_start += datetime.timedelta(days=1)
+        used = await PlannedHoliday.filter(
+            generated_at__gte=tortoise.timezone.now() - since_start
+        ).count()
+        if used >= self.budget:
+            self.logger.info('Generation budget for tonight is used up')
+            return
+
+        pending = await PlannedHoliday.filter(
+            done=False, date__gte=datetime.date.today(),
+            attempts__lt=self.max_attempts
+        ).order_by('date', '-demand').limit(self.budget - used)
+
+        # the same holiday planned for several dates is generated once
+        groups = {}
+        for planned in pending:
+            groups.setdefault(planned.name, []).append(planned)
+
+        self.logger.info(f'Generating images for {len(groups)} '
+                         f'planned holidays')
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+        await asyncio.gather(
+            *(self._generate(group, semaphore) for group in groups.values()))
+
+    async def _generate(self, group, semaphore):
+        async with semaphore:
+            if not self._in_window():
+                return
+
+            holiday_cache, _ = await HolidayCache.get_or_create(
+                name=group[0].name)
+
+            if holiday_cache.images_count <= 0:
+                # count the attempt before downloading, so a crash or
+                # restart still counts against the budget and retries
+                group[0].generated_at = tortoise.timezone.now()
+                for planned in group:
+                    planned.attempts += 1
+                    await planned.save()
+                try:
+                    # shares the per-holiday guard with user requests
+                    await self.holiday_controller.generate_images(
+                        holiday_cache)
+                except Exception:
+                    # the traceback is logged by the holiday controller
+                    pass
+
+            for planned in group:
+                if holiday_cache.images_count > 0:
+                    planned.done = True
+                    await self.holiday_controller.random_index.add(
+                        planned.date, planned.day, planned.name)
+
+                await planned.save()
@@ -0,0 +1,69 @@
+import random
+from collections import Counter
+
+from app.db import HolidayCache, RandomHoliday
+
+
+class RandomHolidayIndex:
+    """In-memory index of (date, holiday) pairs that already have images.
+
+    Entries are persisted in the random_holidays table and loaded on
+    startup, so sampling never touches the network or the database.
+    """
+
+    def __init__(self):
+        self.entries = []
+        self.positions = {}
+        self.dates = Counter()
+
+    def __len__(self):
+        return len(self.entries)
+
+    async def load(self):
+        cached = set(await HolidayCache.filter(images_count__gt=0)
+                     .values_list('name', flat=True))
+
+        for entry in await RandomHoliday.all():
+            if entry.name in cached:
+                self._add(entry.date, entry.day, entry.name)
+
+    def _add(self, date, day, name):
+        key = (date.month, date.day, name)
+        if key in self.positions:
+            return False
+
+        self.positions[key] = len(self.entries)
+        self.dates[(date.month, date.day)] += 1
+        self.entries.append((date, day, name))
+        return True
+
+    def remove(self, date, name):
+        key = (date.month, date.day, name)
+        position = self.positions.pop(key, None)
+        if position is None:
+            return
+
+        # move the last entry into the freed slot to keep removal O(1)
+        last = self.entries.pop()
+        if position < len(self.entries):
+            self.entries[position] = last
+            self.positions[(last[0].month, last[0].day, last[2])] = position
+
+        self.dates[(date.month, date.day)] -= 1
+        if not self.dates[(date.month, date.day)]:
+            del self.dates[(date.month, date.day)]
+
+    async def add(self, date, day, name):
+        if self._add(date, day, name):
+            # the row may exist already if its holiday was not cached
+            # when the index was loaded
+            await RandomHoliday.get_or_create(
+                date=date, name=name, defaults={'day': day})
+
+    def has_date(self, date):
+        return (date.month, date.day) in self.dates
+
+    def sample(self):
+        if not self.entries:
+            return None
+        return random.choice(self.entries)
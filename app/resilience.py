@@ -0,0 +1,53 @@
+import asyncio
+import time
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """Fails fast while an upstream keeps failing.
+
+    After failure_threshold consecutive failures (timeouts included) the
+    circuit opens and calls raise CircuitOpenError for reset_timeout
+    seconds. After that a single probe call is let through while the
+    others keep failing fast: a success closes the circuit again, a
+    failure reopens it.
+    """
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=60):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    @property
+    def is_open(self):
+        return (self.opened_at is not None and
+                time.monotonic() - self.opened_at < self.reset_timeout)
+
+    async def call(self, func, *args, timeout=None, **kwargs):
+        probe = False
+        if self.opened_at is not None:
+            if self.is_open or self.probing:
+                raise CircuitOpenError(f'{self.name} is unavailable')
+            probe = self.probing = True
+
+        try:
+            result = await asyncio.wait_for(func(*args, **kwargs), timeout)
+        except Exception:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            raise
+        finally:
+            if probe:
+                self.probing = False
+
+        self.failures = 0
+        self.opened_at = None
+        return result
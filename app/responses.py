@@ -0,0 +1,139 @@
+import hashlib
+import os
+from email.utils import formatdate
+
+import anyio
+from starlette.responses import Response
+
+
+def _parse_range(value, size):
+    """Parse a single "bytes=" range into a (start, end) half-open pair.
+
+    Returns None when the header should be ignored (other units, several
+    ranges, malformed) and an empty tuple when it is not satisfiable.
+    """
+    unit, _, ranges = value.partition('=')
+    if unit.strip() != 'bytes' or ',' in ranges:
+        return None
+
+    start, sep, end = ranges.strip().partition('-')
+    if not sep:
+        return None
+
+    try:
+        if not start:
+            suffix = int(end)
+            if suffix <= 0:
+                return ()
+            start, end = max(size - suffix, 0), size
+        else:
+            start = int(start)
+            if end and int(end) < start:
+                # last byte before the first one is invalid syntax
+                return None
+            end = min(int(end) + 1, size) if end else size
+    except ValueError:
+        return None
+
+    if start >= size or start >= end:
+        return ()
+    return start, end
+
+
+def _etag_matches(value, etag):
+    tags = [tag.strip() for tag in value.split(',')]
+    return '*' in tags or any(tag.replace('W/', '', 1) == etag
+                              for tag in tags)
+
+
+class ImageFileResponse(Response):
+    """Streams a finished image file from disk.
+
+    Handles If-None-Match and single Range requests, and uses the ASGI
+    zero-copy send extension when the server supports it. Otherwise the
+    file is sent in fixed-size chunks, so memory per request is constant.
+    """
+
+    chunk_size = 64 * 1024
+
+    def __init__(self, path, request_headers, media_type='image/png',
+                 immutable=True):
+        self.path = path
+        self.media_type = media_type
+        self.background = None
+        self.status_code = 200
+
+        stat_result = os.stat(path)
+        size = stat_result.st_size
+        etag_base = f'{stat_result.st_mtime}-{size}'
+        etag = f'"{hashlib.md5(etag_base.encode()).hexdigest()}"'
+
+        headers = {
+            'etag': etag,
+            'last-modified': formatdate(stat_result.st_mtime, usegmt=True),
+            'accept-ranges': 'bytes',
+            'cache-control': ('public, max-age=31536000, immutable'
+                              if immutable else 'no-cache'),
+        }
+        self.start, self.end = 0, size
+
+        if_none_match = request_headers.get('if-none-match')
+        range_header = request_headers.get('range')
+        if_range = request_headers.get('if-range')
+
+        if if_none_match and _etag_matches(if_none_match, etag):
+            self.status_code = 304
+        elif range_header and (not if_range or if_range == etag):
+            byte_range = _parse_range(range_header, size)
+            if byte_range == ():
+                self.status_code = 416
+                headers['content-range'] = f'bytes */{size}'
+                headers['content-length'] = '0'
+            elif byte_range:
+                self.status_code = 206
+                self.start, self.end = byte_range
+                headers['content-range'] = \
+                    f'bytes {self.start}-{self.end - 1}/{size}'
+
+        if self.status_code in (200, 206):
+            headers['content-length'] = str(self.end - self.start)
+
+        self.init_headers(headers)
+
+    async def __call__(self, scope, receive, send):
+        await send({
+            'type': 'http.response.start',
+            'status': self.status_code,
+            'headers': self.raw_headers,
+        })
+
+        count = self.end - self.start
+        if self.status_code not in (200, 206) or count == 0:
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+
+        if 'http.response.zerocopysend' in scope.get('extensions', {}):
+            with open(self.path, 'rb') as f:
+                await send({
+                    'type': 'http.response.zerocopysend',
+                    'file': f,
+                    'offset': self.start,
+                    'count': count,
+                })
+            return
+
+        async with await anyio.open_file(self.path, mode='rb') as f:
+            await f.seek(self.start)
+            remaining = count
+            while remaining > 0:
+                chunk = await f.read(min(self.chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                await send({
+                    'type': 'http.response.body',
+                    'body': chunk,
+                    'more_body': remaining > 0,
+                })
+            if remaining > 0:
+                await send({'type': 'http.response.body', 'body': b''})
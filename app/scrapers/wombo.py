@@ -18,30 +18,44 @@ load_dotenv()
 
 
 class WomboScraper(Scraper):
+    request_timeout = 30
+    task_timeout = 120
+    rate_limit_retries = 5
+
     async def download_images(self, holiday_cache: HolidayCache, count=20):
         path = Path(f"./cache/{holiday_cache.directory}")
         path.mkdir(parents=True, exist_ok=True)
 
-        async with aiohttp.ClientSession() as session:
+        timeout = aiohttp.ClientTimeout(total=self.request_timeout)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
             await self._sign_up(session)
 
             wombo_styles = await self.get_wombo_styles(session)
 
-            for i in range(count):
+            # new images are added after the existing ones
+            start = self._count_images(path)
+            for i in range(start, start + count):
                 url = await self.get_url_from_wombo(
                     session, holiday_cache.name,
                     random.choice(wombo_styles)['id'])
 
                 await self.save_file(session, url, path / f'{i}.jpg')
 
-        return len(list(path.glob('*')))
+        return self._count_images(path)
+
+    def _count_images(self, path):
+        return len([p for p in path.glob('*') if p.suffix != '.tmp'])
 
     async def save_file(self, session: aiohttp.ClientSession, url, path):
         r = await session.get(url)
 
-        async with aiofiles.open(path, 'wb') as f:
+        # written under a temporary name, so a render never reads a
+        # half-written image
+        temp_path = path.with_suffix('.tmp')
+        async with aiofiles.open(temp_path, 'wb') as f:
             async for data in r.content:
                 await f.write(data)
+        os.replace(temp_path, path)
 
     async def _sign_up(self, session: aiohttp.ClientSession):
         r = await session.post(
@@ -62,7 +76,8 @@ class WomboScraper(Scraper):
 
         return script['props']['pageProps']['artStyles']
 
-    async def get_url_from_wombo(self, session, holiday_title, style):
+    async def get_url_from_wombo(self, session, holiday_title, style,
+                                 retries=0):
         headers = {'Authorization': f'bearer {self.auth_token}'}
 
         await session.options('https://paint.api.wombo.ai/api/tasks')
@@ -73,9 +88,11 @@ class WomboScraper(Scraper):
 
         if ('detail' in tasks_info) and \
                 tasks_info['detail'] == 'User has been rate-limited':
-            print('Rate limited....')
+            if retries >= self.rate_limit_retries:
+                raise RuntimeError('Wombo keeps rate limiting requests')
             await asyncio.sleep(25)
-            return await self.get_url_from_wombo(session, holiday_title, style)
+            return await self.get_url_from_wombo(
+                session, holiday_title, style, retries + 1)
 
         task_id = tasks_info['id']
 
@@ -90,15 +107,20 @@ class WomboScraper(Scraper):
                     "display_freq": 10}
                 }, headers=headers)
 
+        deadline = asyncio.get_event_loop().time() + self.task_timeout
         while True:
             task_state = await session.get(
                 f'https://paint.api.wombo.ai/api/tasks/{task_id}',
                 headers=headers)
             task_state = await task_state.json()
-            if task_state['state'] != 'completed':
-                await asyncio.sleep(1)
-            else:
+            if task_state['state'] == 'completed':
                 break
+            if task_state['state'] == 'failed':
+                raise RuntimeError(f'Wombo task {task_id} failed')
+            if asyncio.get_event_loop().time() > deadline:
+                raise asyncio.TimeoutError(
+                    f'Wombo task {task_id} is not completed')
+            await asyncio.sleep(1)
 
         task_state = await session.get(
             f'https://paint.api.wombo.ai/api/tasks/{task_id}', headers=headers)
@@ -1,6 +1,7 @@
 import app.db as db
 import app.holiday as holiday
 import app.log
+from app.planner import GenerationPlanner
 
 from tortoise import Tortoise, run_async
 
@@ -18,6 +19,7 @@ load_dotenv()
 
 scheduler = None
 holiday_controller = holiday.HolidayController()
+planner = GenerationPlanner(holiday_controller)
 logger = app.log.get_logger('main')
 
 bot = aiogram.Bot(token=os.getenv('TG_TOKEN'))
@@ -72,8 +74,7 @@ async def send_today(message: aiogram.types.Message):
 @dp.message_handler(commands=['random'])
 async def send_random(message: aiogram.types.Message):
     msg = await message.reply('⏳ Ожидайте...')
-    img, day = await holiday_controller.get_date_prepared_image(
-        holiday_controller._get_random_date())
+    img, day = await holiday_controller.get_random_prepared_image()
 
     await bot.delete_message(msg.chat.id, msg.message_id)
     await message.reply_photo(img, caption=day)
@@ -127,6 +128,7 @@ async def run():
     await Tortoise.init(db_url=os.getenv('DB_URL'), modules={"models": [db]})
     await Tortoise.generate_schemas()
 
+    await holiday_controller.random_index.load()
     await holiday_controller.update_holidays()
 
 
@@ -135,6 +137,16 @@ async def _update_holidays():
     await holiday_controller.update_holidays()
 
 
+@logger.catch
+async def _plan_generation():
+    await planner.run()
+
+
+@logger.catch
+async def _grow_random_index():
+    await holiday_controller.grow_random_index()
+
+
 async def process_subscribers():
     enabled_subscribers = await db.Subscriber.filter(enabled=True)
     for subscriber in enabled_subscribers:
@@ -168,6 +180,17 @@ def start_scheduler():
             _update_holidays,
             'cron', id='updateHolidays', hour=3, minute=0)
 
+    if not scheduler.get_job('planGeneration'):
+        scheduler.add_job(
+            _plan_generation,
+            'cron', id='planGeneration', minute=15,
+            hour=planner.window_hours)
+
+    if not scheduler.get_job('growRandomIndex'):
+        scheduler.add_job(
+            _grow_random_index,
+            'interval', id='growRandomIndex', minutes=30)
+
 
 if __name__ == "__main__":
     run_async(run())